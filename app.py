@@ -1,10 +1,17 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, request, render_template, Response
 from flask_cors import CORS
+import orjson
 import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import register_default_jsonb
+import atexit
 import os
 import time
+from contextlib import contextmanager
 from dotenv import load_dotenv
-import json
+
+# Decode JSONB coming back from PostgreSQL with orjson instead of stdlib json
+register_default_jsonb(loads=orjson.loads, globally=True)
 
 # Load environment variables
 load_dotenv(r'd:\curiologix\barcode\.env')
@@ -19,19 +26,58 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 
-def get_db_connection():
+# Connection pool (created once at startup) so each request reuses an open
+# connection instead of paying the full connect/auth handshake per query
+try:
+    PG_POOL = pool.ThreadedConnectionPool(
+        minconn=2,
+        maxconn=20,
+        dbname=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT
+    )
+except Exception as e:
+    print(f"Error creating connection pool: {e}")
+    PG_POOL = None
+
+@atexit.register
+def close_pool():
+    if PG_POOL:
+        PG_POOL.closeall()
+
+# Prepared once per pooled connection so PostgreSQL parses/plans the barcode
+# lookup a single time; later requests on the same connection only EXECUTE.
+# product_data comes back as text so we can forward the JSON bytes as-is
+# instead of parsing to a dict and re-serializing.
+BARCODE_LOOKUP_PREPARE = """
+    PREPARE barcode_lookup(text) AS
+    SELECT product_data::text FROM mapped_products WHERE barcode = $1 LIMIT 1
+"""
+
+def ensure_prepared(conn):
+    """Run PREPARE on a pooled connection the first time it is borrowed."""
+    if getattr(conn, '_barcode_lookup_prepared', False):
+        return
+    with conn.cursor() as cur:
+        cur.execute(BARCODE_LOOKUP_PREPARE)
+    conn.commit()
+    conn._barcode_lookup_prepared = True
+
+@contextmanager
+def borrow():
+    """Borrow a connection from the pool and always hand it back."""
+    conn = PG_POOL.getconn()
     try:
-        conn = psycopg2.connect(
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            host=DB_HOST,
-            port=DB_PORT
-        )
-        return conn
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
-        return None
+        ensure_prepared(conn)
+        yield conn
+    finally:
+        PG_POOL.putconn(conn)
+
+def json_response(data, status=200):
+    """Serialize with orjson (much faster than jsonify on big product dicts)."""
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
 
 @app.route('/')
 def index():
@@ -43,40 +89,35 @@ def search_product():
     barcode = request.args.get('barcode')
     
     if not barcode:
-        return jsonify({"error": "Barcode parameter is required"}), 400
+        return json_response({"error": "Barcode parameter is required"}, 400)
 
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({"error": "Database connection failed"}), 500
+    if not PG_POOL:
+        return json_response({"error": "Database connection failed"}, 500)
 
     try:
-        with conn.cursor() as cur:
-            # Try to query the 'mapped_products' table first (legacy/current schema)
-            query = "SELECT product_data FROM mapped_products WHERE barcode = %s LIMIT 1;"
-            cur.execute(query, (barcode,))
-            result = cur.fetchone()
-            
-            elapsed_time = (time.time() - start_time) * 1000 # Convert to ms
-            
-            if result:
-                # product_data is already a JSONB object, so psycopg2 returns it as a dict
-                response_data = result[0]
-                # Inject timing info into the response (or wrapper)
-                # Since product_data is the raw object, let's wrap it or just add the field if it's a dict
-                if isinstance(response_data, dict):
-                    response_data['execution_time_ms'] = elapsed_time
+        with borrow() as conn:
+            with conn.cursor() as cur:
+                # Statement is already prepared on this connection; just execute it
+                cur.execute("EXECUTE barcode_lookup(%s);", (barcode,))
+                result = cur.fetchone()
+
+                elapsed_time = (time.time() - start_time) * 1000 # Convert to ms
+
+                if result:
+                    # product_data arrives as raw JSON text; splice the timing
+                    # field in by string surgery so the blob is never re-parsed
+                    raw_json = result[0]
+                    if raw_json.startswith('{') and raw_json.endswith('}'):
+                        sep = ',' if len(raw_json) > 2 else ''
+                        body = raw_json[:-1] + f'{sep}"execution_time_ms":{elapsed_time}}}'
+                        return Response(body, mimetype='application/json')
+                    # Fallback for a non-object top level: parse and wrap
+                    return json_response({"data": orjson.loads(raw_json), "execution_time_ms": elapsed_time})
                 else:
-                    # Fallback if it's somehow not a dict
-                    response_data = {"data": response_data, "execution_time_ms": elapsed_time}
-                    
-                return jsonify(response_data)
-            else:
-                return jsonify({"error": "Product not found", "barcode": barcode, "execution_time_ms": elapsed_time}), 404
-                
+                    return json_response({"error": "Product not found", "barcode": barcode, "execution_time_ms": elapsed_time}, 404)
+
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        conn.close()
+        return json_response({"error": str(e)}, 500)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
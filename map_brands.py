@@ -1,11 +1,29 @@
 import gzip
 import json
 import re
+import orjson
 import os
+from collections import Counter
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool, cpu_count
 import psycopg2
-from psycopg2.extras import execute_batch
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+# rapidgzip parallelizes inflate across cores; fall back to stdlib gzip if missing
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# pyahocorasick matches all brands in one O(n) pass over the text; fall back
+# to the regex alternation if it's missing
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # Load environment variables
 load_dotenv(r'd:\curiologix\barcode\.env')
 
@@ -36,6 +54,160 @@ def get_db_connection():
         print(f"Error connecting to database: {e}")
         return None
 
+def open_products_file(filepath):
+    """Open the .jsonl.gz dump for binary reading, multithreaded when rapidgzip is available.
+
+    Decompression is the dominant cost of the scan and stdlib gzip is
+    single-threaded; both readers only do sequential forward reads, so
+    they are interchangeable here. Lines stay as bytes: orjson parses
+    bytes directly and the prefilter in scan_batch runs on them with
+    C-level substring search.
+    """
+    if rapidgzip is not None:
+        return rapidgzip.open(filepath, parallelization=os.cpu_count())
+    return gzip.open(filepath, 'rb')
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == '_'
+
+def build_matcher(brands):
+    """Build a callable mapping a brands string to the set of canonical names found.
+
+    Prefers an Aho-Corasick automaton, which scans the text once regardless
+    of how many brands there are, instead of backtracking through a
+    200-branch regex alternation per line. Word boundaries are checked
+    manually to keep the same semantics as the old \\b(...)\\b pattern.
+    """
+    if ahocorasick is not None:
+        automaton = ahocorasick.Automaton()
+        for brand in brands:
+            # Span arithmetic runs against the lowercased haystack, so the
+            # stored length must be that of the lowercased key (lowercasing
+            # can change a string's length, e.g. 'İ' -> 'i̇')
+            key = brand.lower()
+            automaton.add_word(key, (len(key), brand))
+        automaton.make_automaton()
+
+        def find_brands(text):
+            haystack = text.lower()
+            hits = []
+            for end, (length, canonical) in automaton.iter(haystack):
+                start = end - length + 1
+                if start > 0 and _is_word_char(haystack[start - 1]):
+                    continue
+                if end + 1 < len(haystack) and _is_word_char(haystack[end + 1]):
+                    continue
+                hits.append((start, end, canonical))
+
+            # Keep only maximal matches: the regex alternation consumes
+            # "Soya Supreme" as one match, so a hit nested inside a longer
+            # hit (here "Supreme") must not be reported separately
+            found = set()
+            for start, end, canonical in hits:
+                contained = any(
+                    s <= start and end <= e and (e - s) > (end - start)
+                    for s, e, _ in hits
+                )
+                if not contained:
+                    found.add(canonical)
+            return found
+
+        return find_brands
+
+    # Fallback: the original regex alternation. Branches are built from the
+    # pre-lowercased brands (deduping case variants). Canonicalization of a
+    # raw match is memoized: the same brand spellings recur across millions
+    # of lines, so after warm-up each hit is a single cache probe.
+    normalized_brands = {b.lower(): b for b in brands}
+    escaped_brands = [re.escape(b) for b in normalized_brands]
+    pattern = re.compile(r'\b(' + '|'.join(escaped_brands) + r')\b', re.IGNORECASE)
+
+    @lru_cache(maxsize=None)
+    def canonicalize(raw):
+        return normalized_brands.get(raw.lower())
+
+    def find_brands(text):
+        found = set()
+        for m in pattern.finditer(text):
+            canonical = canonicalize(m.group(0))
+            if canonical:
+                found.add(canonical)
+        return found
+
+    return find_brands
+
+# Worker-side matcher, built once per process via the Pool initializer
+_worker_find_brands = None
+
+def _init_worker(brands):
+    global _worker_find_brands
+    _worker_find_brands = build_matcher(brands)
+
+def scan_batch(lines):
+    """Scan one batch of raw JSONL lines in a worker process.
+
+    Returns (rows, brand_count_delta, scanned, matched) where rows are
+    (barcode, brand_name, product_json) tuples ready for the DB buffer.
+    The main process only merges deltas and writes to PostgreSQL.
+    """
+    rows = []
+    count_delta = Counter()
+    scanned = 0
+    matched = 0
+
+    # Bind everything the loop touches to locals: global and attribute
+    # lookups cost a dict probe per line, locals are an array index
+    loads = orjson.loads
+    dumps = orjson.dumps
+    decode_error = orjson.JSONDecodeError
+    find_brands = _worker_find_brands
+    rows_append = rows.append
+    delta_update = count_delta.update
+
+    for line in lines:
+        scanned += 1
+
+        # Cheap byte prefilter: lines without a brands field can never
+        # match, so skip the JSON parse for them entirely
+        if b'"brands"' not in line:
+            continue
+
+        try:
+            product = loads(line)
+
+            product_brands = product.get('brands', '')
+            if not product_brands:
+                continue
+
+            canonical_matches = find_brands(product_brands)
+            if not canonical_matches:
+                continue
+
+            matched += 1
+            product_json = dumps(product).decode('utf-8')
+            barcode = product.get('code', '')
+            delta_update(canonical_matches)
+            for canonical_name in canonical_matches:
+                rows_append((barcode, canonical_name, product_json))
+
+        except decode_error:
+            continue
+        except Exception as e:
+            # A malformed record (e.g. a non-string brands value) must not
+            # escape the worker and abort the whole pool
+            print(f"Error processing line: {e}")
+            continue
+
+    return rows, count_delta, scanned, matched
+
+def _line_batches(f_in, batch_size):
+    """Yield lists of lines so workers amortize pickling over many lines."""
+    while True:
+        batch = list(islice(f_in, batch_size))
+        if not batch:
+            return
+        yield batch
+
 def setup_database(conn):
     """Create the table if it doesn't exist."""
     create_table_query = """
@@ -47,11 +219,22 @@ def setup_database(conn):
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
     CREATE INDEX IF NOT EXISTS idx_brand_name ON mapped_products(brand_name);
+    CREATE INDEX IF NOT EXISTS idx_barcode ON mapped_products(barcode);
     """
     with conn.cursor() as cur:
         cur.execute(create_table_query)
     conn.commit()
 
+    # lz4 TOAST decompression is much faster than the default pglz when
+    # returning big JSONB blobs; only available on PostgreSQL 14+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE mapped_products ALTER COLUMN product_data SET COMPRESSION lz4;")
+        conn.commit()
+    except Exception as e:
+        print(f"Note: could not enable lz4 compression (requires PostgreSQL 14+): {e}")
+        conn.rollback()
+
 def load_brands(filepath):
     """Load and normalize brands from the JSON file."""
     if not os.path.exists(filepath):
@@ -82,17 +265,15 @@ def main():
     setup_database(conn)
     print("Database connected and table ready.")
 
-    # 3. Compile Regex
-    escaped_brands = [re.escape(b) for b in brands]
-    pattern_str = r'\b(' + '|'.join(escaped_brands) + r')\b'
+    # 3. Build Matcher (validate it compiles before forking workers)
     try:
-        brand_pattern = re.compile(pattern_str, re.IGNORECASE)
+        build_matcher(brands)
     except re.error as e:
         print(f"Error compiling regex: {e}")
         conn.close()
         return
 
-    print("Pattern compiled. Scanning file...")
+    print("Matcher built. Scanning file...")
 
     # 4. Stream and Batch Insert
     matched_count = 0
@@ -103,10 +284,12 @@ def main():
         conn.close()
         return
         
-    normalized_brands = {b.lower(): b for b in brands}
-    brand_counts = {b: 0 for b in brands}
-    
-    batch_size = 1000
+    # Seeded with zeros so unmatched brands still show up in the JSON output
+    brand_counts = Counter(dict.fromkeys(brands, 0))
+
+    # execute_values folds each page into one multi-row INSERT, so batches
+    # can be much larger than with per-statement batching
+    batch_size = 10000
     batch_buffer = []
 
     # ... (previous code)
@@ -120,10 +303,16 @@ def main():
         """Try to save a batch. If it fails, rollback and try one by one."""
         if not batch:
             return
-            
+
         try:
             with conn.cursor() as cur:
-                execute_batch(cur, insert_query, batch)
+                execute_values(
+                    cur,
+                    "INSERT INTO mapped_products (barcode, brand_name, product_data) VALUES %s",
+                    batch,
+                    template="(%s,%s,%s::jsonb)",
+                    page_size=1000
+                )
             conn.commit()
         except Exception as e:
             print(f"Batch commit failed: {e}. Retrying individual rows...")
@@ -138,59 +327,45 @@ def main():
                     print(f"Failed to insert item {item[0]}: {single_e}")
                     conn.rollback()
 
+    # The per-line work (JSON parse + brand match) is pure Python and
+    # GIL-bound, so fan line batches out to a worker pool; the main process
+    # only merges counts and feeds the DB buffer.
+    lines_per_batch = 10000
+
     try:
-        with gzip.open(INPUT_FILE, 'rt', encoding='utf-8') as f_in:
-            for line in f_in:
-                scanned_count += 1
+        with open_products_file(INPUT_FILE) as f_in, \
+             Pool(processes=cpu_count(), initializer=_init_worker, initargs=(brands,)) as pool:
+            for rows, count_delta, scanned, matched in pool.imap_unordered(
+                    scan_batch, _line_batches(f_in, lines_per_batch), chunksize=1):
+                scanned_count += scanned
+                matched_count += matched
+
+                brand_counts.update(count_delta)
+
+                batch_buffer.extend(rows)
+
                 if scanned_count % 50000 == 0:
                     print(f"Scanned {scanned_count} records... Found {matched_count} matches.")
 
-                try:
-                    product = json.loads(line)
-                    product_brands = product.get('brands', '')
-                    
-                    if not product_brands:
-                        continue
-                    
-                    matches = brand_pattern.findall(product_brands)
-                    
-                    if matches:
-                        unique_matches = set(m.lower() for m in matches)
-                        
-                        found_any = False
-                        for m in unique_matches:
-                            if m in normalized_brands:
-                                canonical_name = normalized_brands[m]
-                                brand_counts[canonical_name] += 1
-                                found_any = True
-                                
-                                batch_buffer.append((
-                                    product.get('code', ''),
-                                    canonical_name,
-                                    json.dumps(product)
-                                ))
-                        
-                        if found_any:
-                            matched_count += 1
-                        
-                        # Flush batch
-                        if len(batch_buffer) >= batch_size:
-                            save_batch(batch_buffer)
-                            batch_buffer = []
-
-                except json.JSONDecodeError:
-                    continue
-                except Exception as e:
-                    print(f"Error processing line {scanned_count}: {e}")
-                    # Ensure connection is clean for next iteration
-                    if conn.closed == 0: # 0 = 'not closed'
-                         conn.rollback()
-                    continue
+                # Flush batch
+                if len(batch_buffer) >= batch_size:
+                    save_batch(batch_buffer)
+                    batch_buffer = []
 
         # flush remaining
         if batch_buffer:
             save_batch(batch_buffer)
 
+        # Refresh planner stats after the bulk load (VACUUM cannot run
+        # inside a transaction, hence autocommit)
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("VACUUM ANALYZE mapped_products;")
+            print("VACUUM ANALYZE complete.")
+        except Exception as e:
+            print(f"VACUUM ANALYZE failed: {e}")
+
     except KeyboardInterrupt:
         print("\nProcess interrupted by user.")
     except Exception as e:
@@ -208,8 +383,7 @@ def main():
     
     # Write Counts JSON
     with open(OUTPUT_COUNTS_JSON, 'w', encoding='utf-8') as f:
-        sorted_counts = dict(sorted(brand_counts.items(), key=lambda item: item[1], reverse=True))
-        json.dump(sorted_counts, f, indent=4)
+        json.dump(dict(brand_counts.most_common()), f, indent=4)
     print(f"Brand counts (JSON) saved to: {OUTPUT_COUNTS_JSON}")
 
     # Write Counts Markdown
@@ -217,8 +391,7 @@ def main():
         f.write(f"# Brand Product Counts\n\nTotal Matched Products: {matched_count}\n\n")
         f.write("| Brand | Count |\n")
         f.write("|-------|-------|\n")
-        sorted_items = sorted(brand_counts.items(), key=lambda item: item[1], reverse=True)
-        for brand, count in sorted_items:
+        for brand, count in brand_counts.most_common():
             if count > 0:
                 f.write(f"| {brand} | {count} |\n")
     print(f"Brand counts (MD) saved to: {OUTPUT_COUNTS_MD}")
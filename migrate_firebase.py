@@ -3,6 +3,8 @@ from firebase_admin import credentials, firestore
 import psycopg2
 import os
 import json
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 import time
 
@@ -46,29 +48,46 @@ def init_firebase():
         print(f"Error initializing Firebase: {e}")
         return None
 
-
-import re
-
 # Valid chars for Firestore keys: No dots (.), no slashes (/), no [ ] * ~
+_INVALID_KEY_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+
 def sanitize_data(data):
     """Recursively cleans dictionary keys to be Firestore-safe."""
-    if isinstance(data, dict):
-        new_data = {}
-        for k, v in data.items():
+    # Leaves pass straight through
+    if not isinstance(data, (dict, list)):
+        return data
+
+    if isinstance(data, list):
+        new_list = [sanitize_data(i) for i in data]
+        # Reuse the input list when every element came through untouched,
+        # so clean lists don't defeat the dict-reuse check below
+        if all(new is old for new, old in zip(new_list, data)):
+            return data
+        return new_list
+
+    new_data = {}
+    changed = False
+    for k, v in data.items():
+        # Most OpenFoodFacts keys (product_name, brands, ...) are already
+        # clean ASCII identifiers, so skip the regex for those
+        if isinstance(k, str) and k.isascii() and k.isidentifier() and not k.startswith('__'):
+            clean_key = k
+        else:
             # Replace invalid chars with underscore
             # Keep only alphanumeric and underscore
-            clean_key = re.sub(r'[^a-zA-Z0-9_]', '_', str(k))
-            
+            clean_key = _INVALID_KEY_CHARS.sub('_', str(k))
+
             # Key cannot be empty or start with __ (double underscore reserved)
             if not clean_key or clean_key.startswith('__'):
                 clean_key = 'x_' + clean_key
-                
-            new_data[clean_key] = sanitize_data(v)
-        return new_data
-    elif isinstance(data, list):
-        return [sanitize_data(i) for i in data]
-    else:
-        return data
+
+        clean_value = sanitize_data(v)
+        if clean_key is not k or clean_value is not v:
+            changed = True
+        new_data[clean_key] = clean_value
+
+    # Reuse the input dict when nothing was rewritten
+    return new_data if changed else data
 
 def upload_single_doc(db, collection, barcode, brand_name, product_data_raw):
     """Try to upload a single document. If sanitization fails, upload as string."""
@@ -119,6 +138,56 @@ def upload_single_doc(db, collection, barcode, brand_name, product_data_raw):
         print(f"Error: Could not upload {barcode} even as string: {e2}")
         return False
 
+def commit_chunk(db, collection, rows):
+    """Commit up to 500 rows as one Firestore batch write.
+
+    Returns the number of documents uploaded. On batch failure, falls back
+    to uploading the rows one by one.
+    """
+    batch = db.batch()
+    current_batch_rows = []
+
+    for barcode, brand_name, product_data in rows:
+        if not barcode:
+            continue
+
+        current_batch_rows.append((barcode, brand_name, product_data))
+
+        # Prepare Sanitized Data for Batch
+        if isinstance(product_data, str):
+            try: product_data_obj = json.loads(product_data)
+            except: product_data_obj = {}
+        else:
+            product_data_obj = product_data
+
+        clean_data = sanitize_data(product_data_obj)
+
+        doc_ref = db.collection(collection).document(barcode)
+        doc_data = {
+            'barcode': barcode,
+            'brand_name': brand_name,
+            'product_data': clean_data,
+            'migrated_at': firestore.SERVER_TIMESTAMP,
+            'data_format': 'json_object'
+        }
+        batch.set(doc_ref, doc_data)
+
+    if not current_batch_rows:
+        return 0
+
+    try:
+        batch.commit()
+        return len(current_batch_rows)
+    except Exception as batch_error:
+        print(f"Batch failed ({batch_error}). Retrying items individually...")
+
+        # Fallback: Single Item Upload
+        uploaded = 0
+        for b_barcode, b_brand, b_data in current_batch_rows:
+            if upload_single_doc(db, collection, b_barcode, b_brand, b_data):
+                uploaded += 1
+        return uploaded
+
 def migrate():
     # 1. Connect to PostgreSQL
     pg_conn = get_pg_connection()
@@ -133,70 +202,38 @@ def migrate():
 
     print("Connected to PostgreSQL and Firebase. Starting migration...")
 
-    # 3. Stream data from PG
-    BATCH_SIZE = 50 
+    # 3. Stream data from PG, committing batches concurrently — Firestore
+    # RTT dominates and the SDK releases the GIL during network I/O
+    BATCH_SIZE = 500  # Firestore's batch write limit
+    MAX_WORKERS = 16
     PRODUCTS_COLLECTION = 'products'
-    
+
     total_migrated = 0
     start_time = time.time()
 
     try:
-        with pg_conn.cursor() as cur:
-            cur.execute("SELECT barcode, brand_name, product_data FROM mapped_products")
-            
-            while True:
-                rows = cur.fetchmany(BATCH_SIZE)
-                if not rows:
-                    break
-                
-                # Try Batch Write first
-                batch = db.batch()
-                current_batch_rows = [] 
-                
-                for row in rows:
-                    barcode = row[0]
-                    brand_name = row[1] 
-                    product_data = row[2]
-                    
-                    if not barcode:
-                        continue
-                        
-                    current_batch_rows.append((barcode, brand_name, product_data))
-
-                    # Prepare Sanitized Data for Batch
-                    if isinstance(product_data, str):
-                        try: product_data_obj = json.loads(product_data)
-                        except: product_data_obj = {}
-                    else:
-                        product_data_obj = product_data
-                    
-                    clean_data = sanitize_data(product_data_obj)
-                    
-                    doc_ref = db.collection(PRODUCTS_COLLECTION).document(barcode)
-                    doc_data = {
-                        'barcode': barcode,
-                        'brand_name': brand_name,
-                        'product_data': clean_data,
-                        'migrated_at': firestore.SERVER_TIMESTAMP,
-                        'data_format': 'json_object'
-                    }
-                    batch.set(doc_ref, doc_data)
-                
-                try:
-                    batch.commit()
-                    total_migrated += len(current_batch_rows)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Named cursor keeps the result set server-side so the client
+            # streams rows instead of loading the whole table up front
+            with pg_conn.cursor(name='migration_cursor') as cur:
+                cur.itersize = 5000
+                cur.execute("SELECT barcode, brand_name, product_data FROM mapped_products")
+
+                while True:
+                    rows = cur.fetchmany(BATCH_SIZE * MAX_WORKERS)
+                    if not rows:
+                        break
+
+                    chunks = [rows[i:i + BATCH_SIZE] for i in range(0, len(rows), BATCH_SIZE)]
+                    futures = [
+                        executor.submit(commit_chunk, db, PRODUCTS_COLLECTION, chunk)
+                        for chunk in chunks
+                    ]
+                    for future in as_completed(futures):
+                        total_migrated += future.result()
+
                     elapsed = time.time() - start_time
                     print(f"Migrated {total_migrated} records... ({elapsed:.2f}s elapsed)")
-                except Exception as batch_error:
-                    print(f"Batch failed ({batch_error}). Retrying items individually...")
-                    
-                    # Fallback: Single Item Upload
-                    for b_barcode, b_brand, b_data in current_batch_rows:
-                         if upload_single_doc(db, PRODUCTS_COLLECTION, b_barcode, b_brand, b_data):
-                             total_migrated += 1
-                    
-                    elapsed = time.time() - start_time
-                    print(f"Recovered batch. Total: {total_migrated}")
 
     except Exception as e:
         print(f"Migration loop failed: {e}")